@@ -0,0 +1,6 @@
+# Production server settings: gunicorn -c gunicorn.conf.py main:app
+# Runs unchanged under PyPy for the JIT: pypy3 -m gunicorn -c gunicorn.conf.py main:app
+
+bind = '127.0.0.1:8080'
+workers = 1  # Concerts are kept in memory, each worker process would have its own copy
+threads = 4  # The Store is thread safe, requests of the single worker are served by a thread pool
@@ -1,71 +1,278 @@
-from flask import Flask, jsonify, request, Response
+from flask import Flask, request, Response
 from datetime import datetime
-from copy import deepcopy
+from functools import lru_cache
+from itertools import islice
+import threading
+import orjson
 
 
 app = Flask('RestAPI')
 
 
-concerts = [{'id': 1, 'artist': 'Pink Floyd', 'venue': 'Werchter',
-             'date': datetime.fromisoformat('2017-07-20T20:00:00-02:00')},
-            {'id': 2, 'artist': 'Kraftwerk',  'venue': 'Domaine National de St Cloud',
-             'date': datetime.fromisoformat('2022-09-26T15:00:00-02:00')}]
-concerts_key = 3  # Sort of table autoincrement counter
+output_fields = ('id', 'artist', 'venue', 'date')  # Fields of a concert record, in output order
+
+
+def iso_date(value):
+    """
+    :param value: A date in iso format
+    :return: The date validated and normalized to the datetime.isoformat() form,
+             raise a ValueError if the date is not in iso format
+    """
+    if not isinstance(value, str):
+        raise ValueError(value)
+    return datetime.fromisoformat(value).isoformat()
+
+
+def new_concert(identity, artist, venue, date):
+    """
+    :param identity: Id of the concert
+    :param artist: Artist name
+    :param venue: Venue name
+    :param date: Normalized iso string of the concert date, see iso_date
+    :return: A concert record
+    """
+    return {'id': identity, 'artist': artist, 'venue': venue, 'date': date}
+
+
+class Store:
+    """
+    In memory concerts table indexed by id, safe to share between threads.
+    Writers serialize on a lock and publish a new dictionary instead of mutating the current one (copy-on-write),
+    so readers never lock: the dictionary they got stays unchanged.
+    The version is bumped after each publication: read it before the records to never pair it with older content.
+    """
+
+    def __init__(self, records):
+        """
+        :param records: Initial concert records
+        """
+        self._by_id = {record['id']: record for record in records}
+        self._key = max(self._by_id, default=0) + 1  # Sort of table autoincrement counter
+        self._version = 0  # Incremented on every write
+        self._lock = threading.Lock()
+
+    def __contains__(self, identity):
+        return identity in self._by_id
+
+    @property
+    def version(self):
+        """
+        :return: Version of the table content, changes on every write
+        """
+        return self._version
+
+    def get(self, identity):
+        """
+        :param identity: Id of a concert
+        :return: The concert record, None if not found
+        """
+        return self._by_id.get(identity)
+
+    def snapshot(self):
+        """
+        :return: View of all the concert records, unaffected by later writes since a published dictionary
+                 is never mutated
+        """
+        return self._by_id.values()
+
+    def _bump_key(self, identity):
+        """
+        :param identity: Id of a newly created concert
+        :return: Move the autoincrement counter past identity so generated ids never collide with it
+        """
+        self._key = max(self._key, identity + 1)
+
+    def _publish(self, by_id):
+        """
+        :param by_id: New concerts dictionary, replacing the current one. Must be called with the lock held
+        """
+        self._by_id = by_id
+        self._version += 1
+
+    def create(self, artist, venue, date, identity=None):
+        """
+        :param artist: Artist name
+        :param venue: Venue name
+        :param date: Normalized iso string of the concert date
+        :param identity: Id of the concert, generated if None
+        :return: Id of the created concert, None if identity is already used
+        """
+        with self._lock:
+            if identity is None:
+                identity = self._key
+            elif identity in self._by_id:
+                return None
+            self._bump_key(identity)
+            self._publish({**self._by_id, identity: new_concert(identity, artist, venue, date)})
+        return identity
+
+    def put(self, identity, artist, venue, date):
+        """
+        :param identity: Id of the concert
+        :param artist: Artist name
+        :param venue: Venue name
+        :param date: Normalized iso string of the concert date
+        :return: True if the concert was created, False if an existing one was replaced
+        """
+        with self._lock:
+            created = identity not in self._by_id
+            if created:
+                self._bump_key(identity)
+            self._publish({**self._by_id, identity: new_concert(identity, artist, venue, date)})
+        return created
+
+    def update(self, identity, changes):
+        """
+        :param identity: Id of the concert
+        :param changes: Dictionary of the fields to update
+        :return: True if the concert was updated, False if not found
+        """
+        with self._lock:
+            concert = self._by_id.get(identity)
+            if concert is None:
+                return False
+            self._publish({**self._by_id, identity: {**concert, **changes}})
+        return True
+
+    def delete(self, identity):
+        """
+        :param identity: Id of the concert
+        :return: The deleted concert record, None if not found
+        """
+        with self._lock:
+            by_id = dict(self._by_id)
+            concert = by_id.pop(identity, None)
+            if concert is not None:
+                self._publish(by_id)
+        return concert
+
+
+concerts = Store([new_concert(1, 'Pink Floyd', 'Werchter', '2017-07-20T20:00:00-02:00'),
+                  new_concert(2, 'Kraftwerk', 'Domaine National de St Cloud', '2022-09-26T15:00:00-02:00')])
+
+
+class ResponseCache:
+    """
+    GET /concerts response bodies, each tagged with the concerts version it was built from, safe to share between
+    threads. Query strings are client supplied, so the total size of the bodies is bounded.
+    """
+
+    def __init__(self, max_bytes):
+        """
+        :param max_bytes: Maximum total size of the cached bodies
+        """
+        self._bodies = {}  # (limit, offset, fields) -> (concerts version, response body)
+        self._bytes = 0  # Total size of the cached bodies
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        """
+        :param key: (limit, offset, fields) of the request
+        :param version: Current version of the concerts table
+        :return: The cached body, None if not cached or built from another version
+        """
+        with self._lock:
+            cached = self._bodies.get(key)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        return None
+
+    def put(self, key, version, body):
+        """
+        :param key: (limit, offset, fields) of the request
+        :param version: Version of the concerts table the body was built from
+        :param body: Serialized response body, not cached if larger than the whole cache
+        """
+        if len(body) > self._max_bytes:
+            return
+        with self._lock:
+            replaced = self._bodies.pop(key, None)
+            if replaced is not None:
+                self._bytes -= len(replaced[1])
+            if self._bytes + len(body) > self._max_bytes:
+                self._bodies.clear()
+                self._bytes = 0
+            self._bodies[key] = (version, body)
+            self._bytes += len(body)
+
+
+response_cache = ResponseCache(16 * 1024 * 1024)
+response_cache_records = 1000  # Larger pages are streamed, not cached
+
+
+def jout(obj, status=200):
+    """
+    :param obj: Object to serialize
+    :param status: HTTP status
+    :return: A JSON response serialized with orjson
+    """
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
+
+
+def jin():
+    """
+    :return: The request JSON object parsed with orjson,
+             None if the Content-Type is not 'application/json' or the payload is not a valid JSON object,
+             request.is_json tells the two cases apart
+    """
+    if request.is_json:
+        try:
+            body = orjson.loads(request.get_data(cache=False))
+        except orjson.JSONDecodeError:
+            return None
+        if isinstance(body, dict):
+            return body
+    return None
 
 
 def limit_offset(content_list, limit, offset):
     """
-    :param content_list: the list on which limit and offset apply
+    :param content_list: the list or dictionary view on which limit and offset apply
     :param limit: limit the number of records returned
     :param offset: index of the 1st record returned
-    :return: if limit or offset is not 0, return a subset of the list else the whole list
+    :return: the list of records from offset, at most limit of them if limit is not 0,
+             content_list itself when the whole of it is selected
     """
-    if limit or offset:
-        return content_list[offset:offset + limit]
-    return content_list
+    if not offset and (not limit or limit >= len(content_list)):
+        return content_list
+    return list(islice(content_list, offset, offset + limit if limit else None))
 
 
-def reduce_fields(content_list, fields):
+@lru_cache(maxsize=128)
+def select_fields(fields):
     """
-    :param content_list: List of Dictionary
-    :param fields: Comma separated list of dictionary key names to keep
-    :return: Return the list of Dictionary with only the selected fields
+    :param fields: Comma separated list of output field names to keep, all fields if empty
+    :return: Tuple of field names to project, memoized per fields string. output_fields itself when all are kept
     """
     if fields:
         fields = set(fields.split(','))
-        return [{k: v for k, v in c.items() if k in fields} for c in content_list]
-    return content_list
+        keys = tuple(k for k in output_fields if k in fields)
+        if len(keys) < len(output_fields):
+            return keys
+    return output_fields
 
 
-def encode_date(content_list, fields='date'):
+def project(record, keys):
     """
-    :param content_list: List of Dictionary
-    :param fields: Comma separated list of dictionary key to convert the datetime to iso format
-    :return: For each record, encode the datetime field(s) into iso string(s)
+    :param record: A concert record
+    :param keys: Field names, see select_fields
+    :return: The output Dictionary of the record with only the selected fields,
+             the record itself when all fields are kept
     """
-    assert fields != ''
+    if keys is output_fields:  # Records hold exactly the output fields, no copy needed
+        return record
+    return {k: record[k] for k in keys}
 
-    fields = fields.split(',')
-    if content_list and all(field in content_list[0] for field in fields):
-        content_list = deepcopy(content_list)
-        for index in range(len(content_list)):
-            for field in fields:
-                content_list[index][field] = content_list[index][field].isoformat()
-    return content_list
 
-
-def content_index(content_list, field='id', value=None):
+def reduce_fields(content_list, fields):
     """
-    :param content_list: List of record
-    :param field: field name to search on
-    :param value: Value to search for
-    :return: return the first found index of a record where record[field]==value
+    :param content_list: List of records
+    :param fields: Comma separated list of output field names to keep, all fields if empty
+    :return: Return the list of Dictionary with only the selected fields
     """
-    if content_list and field in content_list[0]:
-        for index in range(len(content_list)):
-            if content_list[index][field] == value:
-                return index
-    return None
+    keys = select_fields(fields)
+    return [project(c, keys) for c in content_list]
 
 
 @app.route('/concerts', methods=['POST'])
@@ -75,38 +282,35 @@ def post_concerts():
              newly-created resource with the 201 HTTP status.
              Else return an error message and HTTP status 400
     """
-    global concerts
-    global concerts_key
-
-    if request.is_json:  # true if Content-Type == 'application/json'
+    body = jin()
+    if body is not None:
         try:  # Try to read artist, venue and date
-            artist = request.json['artist']
-            venue = request.json['venue']
-            dt = datetime.fromisoformat(request.json['date'])
+            artist = body['artist']
+            venue = body['venue']
+            date = iso_date(body['date'])
         except KeyError:
-            return jsonify({'error': 'Missing field(s)'}), 400
+            return jout({'error': 'Missing field(s)'}, 400)
         except ValueError:
-            return jsonify({'error': 'Wrong datetime format'}), 400
+            return jout({'error': 'Wrong datetime format'}, 400)
 
         try:  # Try to read id
-            identity = int(request.json['id'])
-            if content_index(concerts, 'id', identity):
-                return jsonify({'error': 'Resource already exists'}), 400
-            concerts_key = concerts_key if identity < concerts_key else identity+1
+            identity = int(body['id'])
         except KeyError:  # Else generate a new key
-            identity = concerts_key
-            concerts_key += 1
+            identity = None
 
         # Create and add a new concert
-        concert = {'id': identity, 'artist': artist, 'venue': venue, 'date': dt}
-        concerts.append(concert)
+        identity = concerts.create(artist, venue, date, identity)
+        if identity is None:
+            return jout({'error': 'Resource already exists'}, 400)
 
         # Return the response
         response = Response()
         response.headers['location'] = f'/concerts/{identity}'
         return response, 201
+    elif request.is_json:
+        return jout({'error': 'Invalid JSON payload'}, 400)
     else:
-        return jsonify({'error': 'Incorrect Content-Type'}), 400
+        return jout({'error': 'Incorrect Content-Type'}, 400)
 
 
 @app.route('/concerts/<int:identity>', methods=['POST'])
@@ -116,10 +320,10 @@ def post_concerts_id(identity):
     :return: If a resource with the id exist, return an error message and HTTP status 409
              Else return an error message and HTTP status 404
     """
-    if content_index(concerts, 'id', identity):
-        return jsonify({'error': 'Resource already exists'}), 409
+    if identity in concerts:
+        return jout({'error': 'Resource already exists'}, 409)
     else:
-        return jsonify({'error': 'Resource not found'}), 404
+        return jout({'error': 'Resource not found'}, 404)
 
 
 @app.route('/concerts', methods=['GET'])
@@ -129,15 +333,33 @@ def get_concerts():
              /concerts?limit=10&offset=10
              /concerts?fields=id,artist
     """
-    limit = int(request.args.get('limit') or 0)
-    offset = int(request.args.get('offset') or 0)
+    limit = request.args.get('limit', 0, type=int)  # Invalid values fall back to 0
+    offset = request.args.get('offset', 0, type=int)
     fields = request.args.get('fields')
 
-    concerts_temp = limit_offset(concerts, limit, offset)
-    concerts_temp = reduce_fields(concerts_temp, fields)
-    concerts_temp = encode_date(concerts_temp, 'date')
+    key = (limit, offset, fields)
+    version = concerts.version  # Read before the snapshot, see Store
+    cached = response_cache.get(key, version)
+    if cached is not None:
+        return Response(cached, status=200, mimetype='application/json')
+
+    concerts_temp = limit_offset(concerts.snapshot(), limit, offset)
+    keys = select_fields(fields)
+
+    if len(concerts_temp) <= response_cache_records:  # Small page, serialize it at once and cache it
+        body = orjson.dumps([project(concert, keys) for concert in concerts_temp])
+        response_cache.put(key, version, body)
+        return Response(body, status=200, mimetype='application/json')
+
+    def generate():  # Stream the JSON array one record at a time
+        yield b'['
+        for index, concert in enumerate(concerts_temp):
+            if index:
+                yield b','
+            yield orjson.dumps(project(concert, keys))
+        yield b']'
 
-    return jsonify(concerts_temp), 200
+    return Response(generate(), status=200, mimetype='application/json')
 
 
 @app.route('/concerts/<int:identity>', methods=['GET'])
@@ -149,15 +371,13 @@ def get_concerts_id(identity):
     """
     fields = request.args.get('fields')
 
-    index = content_index(concerts, 'id', identity)
-    if index:
-        concert_temp = [concerts[index]]
-        concert_temp = reduce_fields(concert_temp, fields)
-        concert_temp = encode_date(concert_temp, 'date')
+    concert = concerts.get(identity)
+    if concert is not None:
+        concert_temp = reduce_fields([concert], fields)
 
-        return jsonify(concert_temp[0])
+        return jout(concert_temp[0])
     else:
-        return jsonify({'error': 'Resource not found'}), 404
+        return jout({'error': 'Resource not found'}, 404)
 
 
 @app.route('/concerts', methods=['PUT'])
@@ -165,7 +385,7 @@ def put_concerts():
     """
     :return: An error message and HTTP status 405
     """
-    return jsonify({'error': 'Method Not Allowed'}), 405
+    return jout({'error': 'Method Not Allowed'}, 405)
 
 
 @app.route('/concerts/<int:identity>', methods=['PUT'])
@@ -175,30 +395,25 @@ def put_concerts_id(identity):
     :return: If identity is found, update the selected concert with a new record and return an HTTP status 204
              else create aa new concert an return an HTTP status 201
     """
-    global concerts
-    global concerts_key
-
-    if request.is_json:  # true if Content-Type == 'application/json'
+    body = jin()
+    if body is not None:
         try:  # Try to read artist, venue and date
-            artist = request.json['artist']
-            venue = request.json['venue']
-            dt = datetime.fromisoformat(request.json['date'])
+            artist = body['artist']
+            venue = body['venue']
+            date = iso_date(body['date'])
         except KeyError:
-            return jsonify({'error': 'Missing field(s)'}), 400
-
-        # Concert
-        concert = {'id': identity, 'artist': artist, 'venue': venue, 'date': dt}
+            return jout({'error': 'Missing field(s)'}, 400)
+        except ValueError:
+            return jout({'error': 'Wrong datetime format'}, 400)
 
-        index = content_index(concerts, 'id', identity)
-        if index:  # Update an existing concert
-            concerts[index] = concert
-            return '', 204
-        else:  # Create a new concert
-            concerts_key = concerts_key if identity < concerts_key else identity+1
-            concerts.append(concert)
+        if concerts.put(identity, artist, venue, date):  # Created a new concert
             return '', 201
+        else:  # Updated an existing concert
+            return '', 204
+    elif request.is_json:
+        return jout({'error': 'Invalid JSON payload'}, 400)
     else:
-        return jsonify({'error': 'Incorrect Content-Type or no JSON payload'}), 400
+        return jout({'error': 'Incorrect Content-Type or no JSON payload'}, 400)
 
 
 @app.route('/concerts', methods=['PATCH'])
@@ -206,7 +421,7 @@ def patch_concerts():
     """
     :return: An error message and HTTP status 405
     """
-    return jsonify({'error': 'Method Not Allowed'}), 405
+    return jout({'error': 'Method Not Allowed'}, 405)
 
 
 @app.route('/concerts/<int:identity>', methods=['PATCH'])
@@ -216,23 +431,23 @@ def patch_concerts_id(identity):
     :return: If identity is found, update the selected concert fields and return an HTTP status 204
              else return an error message and HTTP status 404
     """
-    global concerts
-    global concerts_key
-
-    if request.is_json:  # true if Content-Type == 'application/json'
-        index = content_index(concerts, 'id', identity)
-        if index:  # Update an existing concert
-            for key in ['artist', 'venue']:
-                if key in request.json:
-                    concerts[index][key] = request.json[key]
-            if 'date' in request.json:
-                concerts[index]['date'] = datetime.fromisoformat(request.json['date'])
-
+    body = jin()
+    if body is not None:
+        changes = {key: body[key] for key in ['artist', 'venue'] if key in body}
+        if 'date' in body:
+            try:
+                changes['date'] = iso_date(body['date'])
+            except ValueError:
+                return jout({'error': 'Wrong datetime format'}, 400)
+
+        if concerts.update(identity, changes):  # Update an existing concert
             return '', 204
         else:
-            return jsonify({'error': 'Resource not found'}), 404
+            return jout({'error': 'Resource not found'}, 404)
+    elif request.is_json:
+        return jout({'error': 'Invalid JSON payload'}, 400)
     else:
-        return jsonify({'error': 'Incorrect Content-Type'}), 400
+        return jout({'error': 'Incorrect Content-Type'}, 400)
 
 
 @app.route('/concerts', methods=['DELETE'])
@@ -240,7 +455,7 @@ def del_concerts():
     """
     :return: An error message and HTTP status 405
     """
-    return jsonify({'error': 'Method Not Allowed'}), 405
+    return jout({'error': 'Method Not Allowed'}, 405)
 
 
 @app.route('/concerts/<int:identity>', methods=['DELETE'])
@@ -250,20 +465,12 @@ def del_concerts_id(identity):
     :return: If identity is found, delete the concert and return the deleted concert content and an HTTP status 200
              else return an error message and HTTP status 404
     """
-    global concerts
-    global concerts_key
-
-    index = content_index(concerts, 'id', identity)
-    if index:
-        concert_temp = [concerts[index]]
-        concert_temp = encode_date(concert_temp, 'date')
-
-        del concerts[index]
-
-        return jsonify(concert_temp[0]), 200
+    concert = concerts.delete(identity)
+    if concert is not None:
+        return jout(concert, 200)
     else:
-        return jsonify({'error': 'Resource not found'}), 404
+        return jout({'error': 'Resource not found'}, 404)
 
 
-if __name__ == '__main__':
+if __name__ == '__main__':  # Development server only, see gunicorn.conf.py for production
     app.run(port=8080, debug=True)
\ No newline at end of file